@@ -15,6 +15,18 @@ class CompressionEngine(Protocol):
             Compressed content summary
         """
         ...
+    
+    async def compress_batch(self, segments: List[str], max_tokens: int) -> List[str]:
+        """Compress several segments independently in a single request
+        
+        Args:
+            segments: Contents to be compressed
+            max_tokens: Maximum token limit for each compressed segment
+            
+        Returns:
+            Compressed summaries, one per segment in the same order
+        """
+        ...
 
 class TokenAnalyzer(Protocol):
     """Token analyzer interface"""
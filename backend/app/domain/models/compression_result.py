@@ -1,3 +1,4 @@
+from dataclasses import dataclass
 from pydantic import BaseModel
 from typing import List, Dict, Any
 
@@ -13,11 +14,9 @@ class CompressionResult(BaseModel):
     class Config:
         arbitrary_types_allowed = True
 
-class CompressionSegment(BaseModel):
-    """Compression segment model"""
+@dataclass(slots=True)
+class CompressionSegment:
+    """Compression segment model (internal, not validated)"""
     content: str
     estimated_tokens: int
-    message_types: List[str]  # Message types contained: user, assistant, tool, etc.
-    
-    class Config:
-        arbitrary_types_allowed = True 
\ No newline at end of file
+    message_types: List[str]  # Message types contained: user, assistant, tool, etc. 
\ No newline at end of file
@@ -12,6 +12,7 @@ class Settings(BaseSettings):
     model_name: str = "deepseek-chat"
     temperature: float = 0.7
     max_tokens: int = 2000
+    max_context_tokens: int = 64000
     
     # MongoDB configuration
     mongodb_uri: str = "mongodb://mongodb:27017"
@@ -1,42 +1,223 @@
 from app.domain.external.compression import CompressionEngine
 from app.domain.external.llm import LLM
 from app.domain.utils.json_parser import JsonParser
+from collections import OrderedDict
+from dataclasses import dataclass
+from contextlib import aclosing
+import asyncio
+import hashlib
 import logging
 import json
-from typing import Dict, Any
+from typing import Optional
 
 logger = logging.getLogger(__name__)
 
+# Kept identical across calls so providers can reuse the cached prompt prefix
+_SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": "You are a professional content compression assistant. Please perform intelligent compression according to user requirements."
+}
+
+_COMPRESSION_TEMPLATE = """
+Please intelligently compress and summarize the following content, following these important rules:
+
+1. **JSON Structure Protection**: If content contains JSON format data (such as plans, steps, tool_calls, etc.), the JSON structure and all field values must be completely preserved
+EXAMPLE JSON:
+{{
+    "message": "User response message",
+    "goal": "Goal description",
+    "title": "Plan title",
+    "steps": [
+        {{
+            "id": "1",
+            "description": "Step 1 description"
+        }}
+    ]
+}}
+You must return the JSON structure exactly as it is, without any modification or addition.
+
+2. **Key Information Retention**: Maintain accuracy and completeness of task objectives, execution status, and tool call results
+3. **Descriptive Compression**: Only compress and simplify descriptive text, preserve all structured data
+4. **Logical Coherence**: Ensure compressed content can support subsequent business logic processing
+5. **Length Limit**: Keep the compressed summary under {summary_tokens} tokens
+
+Current accumulated summary:
+{summary}
+
+New content to be compressed:
+{content}
+
+Please return the compressed content summary, ensuring all JSON structures and key business information are preserved:
+"""
+
+_CLAUDE_COMPRESSION_TEMPLATE = """
+<instructions>
+Compress and summarize the content below.
+- Preserve any JSON data (plans, steps, tool_calls, etc.) exactly as it is, with every field value, e.g.:
+{{"message": "...", "goal": "...", "title": "...", "steps": [{{"id": "1", "description": "..."}}]}}
+- Keep task objectives, execution status and tool call results accurate and complete
+- Only simplify descriptive text
+- Keep the result coherent enough for subsequent processing
+- Keep the summary under {summary_tokens} tokens
+</instructions>
+
+<summary>
+{summary}
+</summary>
+
+<content>
+{content}
+</content>
+
+Return only the compressed summary.
+"""
+
+_DEEPSEEK_COMPRESSION_TEMPLATE = """
+请对以下内容进行智能压缩和总结，并遵守以下规则：
+
+1. **JSON 结构保护**：如果内容包含 JSON 数据（如计划、步骤、tool_calls 等），必须完整保留 JSON 结构和所有字段值，不做任何修改或添加，例如：
+{{"message": "...", "goal": "...", "title": "...", "steps": [{{"id": "1", "description": "..."}}]}}
+2. **关键信息保留**：保持任务目标、执行状态和工具调用结果的准确与完整
+3. **描述性压缩**：只压缩和精简描述性文字，保留所有结构化数据
+4. **逻辑连贯**：确保压缩后的内容能够支撑后续业务逻辑处理
+5. **长度限制**：压缩后的摘要不超过 {summary_tokens} 个 token
+6. **语言一致**：摘要必须使用与原始内容相同的语言撰写
+
+当前累积摘要：
+{summary}
+
+需要压缩的新内容：
+{content}
+
+请返回压缩后的内容摘要，确保保留所有 JSON 结构和关键业务信息：
+"""
+
+_BATCH_COMPRESSION_TEMPLATE = """
+Please compress each of the following {count} segments independently, following these important rules:
+
+1. **JSON Structure Protection**: If a segment contains JSON format data (such as plans, steps, tool_calls, etc.), the JSON structure and all field values must be completely preserved
+2. **Key Information Retention**: Maintain accuracy and completeness of task objectives, execution status, and tool call results
+3. **Descriptive Compression**: Only compress and simplify descriptive text, preserve all structured data
+4. **Logical Coherence**: Ensure compressed content can support subsequent business logic processing
+
+{segments}
+
+Keep each summary under {summary_tokens} tokens.
+Return a JSON object of the form {{"summaries": ["...", "..."]}} containing exactly {count} strings, the compressed summary of each segment in order.
+"""
+
+_CLAUDE_BATCH_COMPRESSION_TEMPLATE = """
+<instructions>
+Compress each of the {count} segments below independently.
+- Preserve any JSON data (plans, steps, tool_calls, etc.) exactly as it is, with every field value
+- Keep task objectives, execution status and tool call results accurate and complete
+- Only simplify descriptive text
+- Keep each summary under {summary_tokens} tokens
+</instructions>
+
+{segments}
+
+Return a JSON object of the form {{"summaries": ["...", "..."]}} containing exactly {count} strings, the compressed summary of each segment in order.
+"""
+
+_DEEPSEEK_BATCH_COMPRESSION_TEMPLATE = """
+请分别独立压缩以下 {count} 个片段，并遵守以下规则：
+
+1. **JSON 结构保护**：如果片段包含 JSON 数据（如计划、步骤、tool_calls 等），必须完整保留 JSON 结构和所有字段值
+2. **关键信息保留**：保持任务目标、执行状态和工具调用结果的准确与完整
+3. **描述性压缩**：只压缩和精简描述性文字，保留所有结构化数据
+4. **逻辑连贯**：确保压缩后的内容能够支撑后续业务逻辑处理
+5. **语言一致**：摘要必须使用与原始内容相同的语言撰写
+
+{segments}
+
+每个摘要不超过 {summary_tokens} 个 token。
+请返回形如 {{"summaries": ["...", "..."]}} 的 JSON 对象，按顺序包含恰好 {count} 个字符串，分别为每个片段的压缩摘要。
+"""
+
+
+@dataclass(frozen=True, slots=True)
+class _PromptSet:
+    """Compression prompts for a model family"""
+    compression_template: str
+    batch_template: str
+    segment_format: str  # Formats one segment of a batch from index and segment
+    empty_summary: str  # Placeholder used when there is no accumulated summary
+
+
+_DEFAULT_PROMPTS = _PromptSet(
+    _COMPRESSION_TEMPLATE,
+    _BATCH_COMPRESSION_TEMPLATE,
+    "SEGMENT {index}:\n{segment}",
+    "(First compression, no historical summary)",
+)
+
+# Compression prompts by model family, matched against the model name
+_PROMPTS_BY_FAMILY = {
+    "gpt": _DEFAULT_PROMPTS,
+    "claude": _PromptSet(
+        _CLAUDE_COMPRESSION_TEMPLATE,
+        _CLAUDE_BATCH_COMPRESSION_TEMPLATE,
+        '<segment index="{index}">\n{segment}\n</segment>',
+        "(none)",
+    ),
+    "deepseek": _PromptSet(
+        _DEEPSEEK_COMPRESSION_TEMPLATE,
+        _DEEPSEEK_BATCH_COMPRESSION_TEMPLATE,
+        "片段 {index}：\n{segment}",
+        "（首次压缩，暂无历史摘要）",
+    ),
+}
+
 class LlmCompressionEngine(CompressionEngine):
     """LLM-based compression engine implementation"""
     
+    CACHE_MAX_SIZE = 128
+    STREAM_CHARS_PER_TOKEN = 4  # Generous upper bound, so the cutoff never fires before the output cap
+    SUMMARY_OUTPUT_RATIO = 0.5  # Share of the LLM output limit a single summary may use
+    MIN_BATCH_SUMMARY_TOKENS = 500  # Output tokens reserved per summary in a batch
+    
     def __init__(self, llm: LLM, json_parser: JsonParser):
         self._llm = llm
         self._json_parser = json_parser
+        self._prompts = self._select_prompts(llm.model_name)
+        # LRU cache of compression results, keyed by digest of summary, content and token budget
+        self._cache: OrderedDict[bytes, str] = OrderedDict()
     
     async def compress_content(self, summary: str, content: str, max_tokens: int) -> str:
         """Implement compression logic"""
         logger.info(f"Starting compression: summary_len={len(summary)}, content_len={len(content)}")
         
+        cached_result = self._get_cached(summary, content, max_tokens)
+        if cached_result is not None:
+            logger.info(f"Compression cache hit: result_len={len(cached_result)}")
+            return cached_result
+        
         try:
             # Build compression prompt
-            compression_prompt = self._get_compression_prompt(summary, content)
+            compression_prompt = self._get_compression_prompt(summary, content, max_tokens)
             
             # Call LLM for compression (using simple message format to avoid recursion)
-            response = await self._llm.ask([
-                {
-                    "role": "system",
-                    "content": "You are a professional content compression assistant. Please perform intelligent compression according to user requirements."
-                },
+            messages = [
+                _SYSTEM_MESSAGE,
                 {
                     "role": "user", 
                     "content": compression_prompt
                 }
-            ])
-            
-            compressed_result = response.get("content", "")
+            ]
+            truncated = False
+            if hasattr(self._llm, "ask_stream"):
+                compressed_result, truncated = await self._ask_streaming(messages)
+            else:
+                response = await self._llm.ask(messages)
+                compressed_result = response.get("content", "")
             logger.info(f"Compression completed: result_len={len(compressed_result)}")
             
+            if truncated:
+                logger.warning("Compression result was truncated, not caching it")
+            else:
+                self._put_cached(summary, content, max_tokens, compressed_result)
+            
             return compressed_result
             
         except Exception as e:
@@ -44,38 +225,130 @@ class LlmCompressionEngine(CompressionEngine):
             # Fallback handling: if compression fails, return truncated original content
             return self._fallback_compression(summary, content, max_tokens)
     
-    def _get_compression_prompt(self, summary: str, content: str) -> str:
+    async def _ask_streaming(self, messages: list[dict[str, str]]) -> tuple[str, bool]:
+        """Stream compression result, aborting once it runs past the LLM output limit
+        
+        The summary budget is stated in the prompt. This cutoff only guards against
+        providers that do not enforce max_tokens.
+        
+        Returns:
+            tuple: (compressed result, whether it was truncated)
+        """
+        max_length = self._llm.max_tokens * self.STREAM_CHARS_PER_TOKEN
+        parts = []
+        length = 0
+        truncated = False
+        async with aclosing(self._llm.ask_stream(messages)) as stream:
+            async for delta in stream:
+                parts.append(delta)
+                length += len(delta)
+                if length > max_length:
+                    logger.warning(f"Compression result exceeds {self._llm.max_tokens} tokens, aborting stream")
+                    truncated = True
+                    break
+        return "".join(parts), truncated
+    
+    async def compress_batch(self, segments: list[str], max_tokens: int) -> list[str]:
+        """Compress several segments in as few LLM calls as the output limit allows"""
+        results = [self._get_cached("", segment, max_tokens) for segment in segments]
+        pending = [index for index, result in enumerate(results) if result is None]
+        logger.info(f"Starting batch compression: segments={len(segments)}, cached={len(segments) - len(pending)}")
+        
+        # All summaries of a batch share one response, so cap the batch by the LLM output limit
+        batch_size = max(1, self._llm.max_tokens // self.MIN_BATCH_SUMMARY_TOKENS)
+        batches = [pending[start:start + batch_size] for start in range(0, len(pending), batch_size)]
+        batch_summaries = await asyncio.gather(*[
+            self._compress_pending_batch([segments[index] for index in batch], max_tokens)
+            for batch in batches
+        ])
+        for batch, summaries in zip(batches, batch_summaries):
+            for index, summary in zip(batch, summaries):
+                results[index] = summary
+        
+        return results
+    
+    async def _compress_pending_batch(self, segments: list[str], max_tokens: int) -> list[str]:
+        """Compress uncached segments in one call, falling back to separate calls"""
+        if len(segments) == 1:
+            return [await self.compress_content("", segments[0], max_tokens)]
+        
+        try:
+            summaries = await self._ask_batch(segments)
+            for segment, summary in zip(segments, summaries):
+                self._put_cached("", segment, max_tokens, summary)
+            logger.info(f"Batch compression completed: segments={len(segments)}")
+            return summaries
+        except Exception as e:
+            logger.error(f"Batch compression failed, compressing segments separately: {e}")
+            return list(await asyncio.gather(*[
+                self.compress_content("", segment, max_tokens) for segment in segments
+            ]))
+    
+    async def _ask_batch(self, segments: list[str]) -> list[str]:
+        """Request compressed summaries of all segments in one call"""
+        segments_text = "\n\n".join(
+            self._prompts.segment_format.format(index=index, segment=segment)
+            for index, segment in enumerate(segments, 1)
+        )
+        # Leave one share of the output limit for JSON overhead
+        summary_tokens = self._llm.max_tokens // (len(segments) + 1)
+        prompt = self._prompts.batch_template.format(
+            count=len(segments), segments=segments_text, summary_tokens=summary_tokens
+        )
+        
+        response = await self._llm.ask(
+            [_SYSTEM_MESSAGE, {"role": "user", "content": prompt}],
+            response_format={"type": "json_object"}
+        )
+        # JSON mode is requested, so invalid JSON (e.g. output cut off at the limit) is a failure
+        parsed = json.loads(response.get("content") or "")
+        summaries = parsed.get("summaries") if isinstance(parsed, dict) else None
+        
+        if not isinstance(summaries, list) or len(summaries) != len(segments) \
+                or not all(isinstance(summary, str) for summary in summaries):
+            raise ValueError(f"Expected {len(segments)} summaries in batch compression response")
+        return summaries
+    
+    def _get_cached(self, summary: str, content: str, max_tokens: int) -> Optional[str]:
+        """Get cached compression result"""
+        cache_key = self._get_cache_key(summary, content, max_tokens)
+        cached_result = self._cache.get(cache_key)
+        if cached_result is not None:
+            self._cache.move_to_end(cache_key)
+        return cached_result
+    
+    def _put_cached(self, summary: str, content: str, max_tokens: int, result: str) -> None:
+        """Store compression result, evicting the least recently used entry"""
+        self._cache[self._get_cache_key(summary, content, max_tokens)] = result
+        if len(self._cache) > self.CACHE_MAX_SIZE:
+            self._cache.popitem(last=False)
+    
+    def _get_cache_key(self, summary: str, content: str, max_tokens: int) -> bytes:
+        """Build cache key from summary, content and token budget"""
+        return hashlib.blake2b(
+            f"{max_tokens}\x00{summary}\x00{content}".encode(), digest_size=16
+        ).digest()
+    
+    def _select_prompts(self, model_name: str) -> _PromptSet:
+        """Select compression prompts for the model family"""
+        model_name = (model_name or "").lower()
+        for family, prompts in _PROMPTS_BY_FAMILY.items():
+            if family in model_name:
+                logger.info(f"Using {family} compression prompts for model: {model_name}")
+                return prompts
+        return _DEFAULT_PROMPTS
+    
+    def _get_compression_prompt(self, summary: str, content: str, max_tokens: int) -> str:
         """Generate compression prompt while protecting JSON structure"""
-        return f"""
-Please intelligently compress and summarize the following content, following these important rules:
-
-1. **JSON Structure Protection**: If content contains JSON format data (such as plans, steps, tool_calls, etc.), the JSON structure and all field values must be completely preserved
-EXAMPLE JSON:
-{{
-    "message": "User response message",
-    "goal": "Goal description",
-    "title": "Plan title",
-    "steps": [
-        {{
-            "id": "1",
-            "description": "Step 1 description"
-        }}
-    ]
-}}
-You must return the JSON structure exactly as it is, without any modification or addition.
-
-2. **Key Information Retention**: Maintain accuracy and completeness of task objectives, execution status, and tool call results
-3. **Descriptive Compression**: Only compress and simplify descriptive text, preserve all structured data
-4. **Logical Coherence**: Ensure compressed content can support subsequent business logic processing
-
-Current accumulated summary:
-{summary or "(First compression, no historical summary)"}
-
-New content to be compressed:
-{content}
-
-Please return the compressed content summary, ensuring all JSON structures and key business information are preserved:
-"""
+        return self._prompts.compression_template.format(
+            summary=summary or self._prompts.empty_summary,
+            content=content,
+            summary_tokens=self._get_summary_tokens(max_tokens)
+        )
+    
+    def _get_summary_tokens(self, max_tokens: int) -> int:
+        """Get token budget of a single summary, stated in the prompt"""
+        return min(max_tokens, int(self._llm.max_tokens * self.SUMMARY_OUTPUT_RATIO))
     
     def _fallback_compression(self, summary: str, content: str, max_tokens: int) -> str:
         """Fallback compression strategy: simple truncation"""
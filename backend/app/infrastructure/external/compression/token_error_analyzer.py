@@ -1,31 +1,44 @@
 from app.domain.external.compression import TokenAnalyzer
+from collections import OrderedDict
+import hashlib
 import re
 import logging
 from typing import Tuple
+import tiktoken
 
 logger = logging.getLogger(__name__)
 
+# Common token error format patterns
+_TOKEN_ERROR_PATTERNS = tuple(re.compile(pattern, re.IGNORECASE) for pattern in [
+    # OpenAI format: "maximum context length is 4096 tokens, however you requested 5000 tokens"
+    r"maximum context length is (\d+) tokens.*?(\d+) tokens",
+    # Other format: "token limit 4096 exceeded, current request: 5000"
+    r"token limit.*?(\d+).*?current.*?(\d+)",
+    # Generic format: "context length exceeded: 5000 > 4096"
+    r"context length exceeded.*?(\d+).*?(\d+)",
+    # DeepSeek and other formats
+    r"Request too large.*?(\d+).*?(\d+)",
+])
+
 class TokenErrorAnalyzer(TokenAnalyzer):
     """Token error analyzer implementation"""
     
+    ENCODING_NAME = "cl100k_base"
+    CACHE_MAX_SIZE = 4096
+    
+    def __init__(self):
+        # Loaded at startup: the first load may download encoding files with blocking I/O,
+        # which must not happen on the event loop during a request
+        self._encoder = self._load_encoder()
+        # LRU cache of token counts, keyed by digest of text to avoid retaining large texts
+        self._cache: OrderedDict[bytes, int] = OrderedDict()
+    
     def parse_error_info(self, error_message: str) -> Tuple[int, int]:
         """Parse API error message to extract token limits"""
         logger.debug(f"Parsing token error: {error_message}")
         
-        # Common token error format patterns
-        patterns = [
-            # OpenAI format: "maximum context length is 4096 tokens, however you requested 5000 tokens"
-            r"maximum context length is (\d+) tokens.*?(\d+) tokens",
-            # Other format: "token limit 4096 exceeded, current request: 5000"
-            r"token limit.*?(\d+).*?current.*?(\d+)",
-            # Generic format: "context length exceeded: 5000 > 4096"
-            r"context length exceeded.*?(\d+).*?(\d+)",
-            # DeepSeek and other formats
-            r"Request too large.*?(\d+).*?(\d+)",
-        ]
-        
-        for pattern in patterns:
-            match = re.search(pattern, error_message, re.IGNORECASE)
+        for pattern in _TOKEN_ERROR_PATTERNS:
+            match = pattern.search(error_message)
             if match:
                 # Usually first number is limit, second is current request
                 num1, num2 = int(match.group(1)), int(match.group(2))
@@ -40,10 +53,33 @@ class TokenErrorAnalyzer(TokenAnalyzer):
         return 4096, 5000  # Default values
     
     def estimate_tokens(self, text: str) -> int:
-        """Simple token estimation (1 token ≈ 4 characters)"""
+        """Count tokens with tiktoken, memoized per text"""
         if not text:
             return 0
         
-        # Simple estimation: English ~4 chars=1token, Chinese ~1.5 chars=1token
-        # Using conservative estimation here
-        return len(text) // 3 
\ No newline at end of file
+        encoder = self._encoder
+        if encoder is None:
+            # Simple estimation: English ~4 chars=1token, Chinese ~1.5 chars=1token
+            # Using conservative estimation here
+            return len(text) // 3
+        
+        cache_key = hashlib.blake2b(text.encode(), digest_size=16).digest()
+        token_count = self._cache.get(cache_key)
+        if token_count is not None:
+            self._cache.move_to_end(cache_key)
+            return token_count
+        
+        token_count = len(encoder.encode(text, disallowed_special=()))
+        self._cache[cache_key] = token_count
+        if len(self._cache) > self.CACHE_MAX_SIZE:
+            self._cache.popitem(last=False)
+        return token_count
+    
+    def _load_encoder(self):
+        """Load tiktoken encoding, falling back to estimation if unavailable"""
+        try:
+            return tiktoken.get_encoding(self.ENCODING_NAME)
+        except Exception as e:
+            # Encoding files are downloaded on first use and may be unreachable
+            logger.warning(f"Failed to load tiktoken encoding, using character estimation: {e}")
+            return None
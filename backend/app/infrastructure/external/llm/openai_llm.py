@@ -1,13 +1,28 @@
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple, AsyncGenerator
 from openai import AsyncOpenAI
 from app.domain.external.llm import LLM
 from app.infrastructure.config import get_settings
+import asyncio
 import logging
+import re
 
 
 logger = logging.getLogger(__name__)
 
+_TOKEN_LIMIT_ERROR_RE = re.compile(
+    r"context_length_exceeded|token limit|maximum context length|request too large|too many tokens",
+    re.IGNORECASE
+)
+
 class OpenAILLM(LLM):
+    # Start background compression once history reaches this share of the context window
+    COMPRESSION_SOFT_LIMIT_RATIO = 0.8
+    # Compress well below the soft limit so the next compression is not due right away
+    COMPRESSION_TARGET_RATIO = 0.5
+    MAX_COMPRESSION_CACHE_SIZE = 32
+    # Initial request plus retries after compressing on token limit errors
+    MAX_ATTEMPTS = 3
+    
     def __init__(self, compression_service=None):
         settings = get_settings()
         self.client = AsyncOpenAI(
@@ -18,7 +33,14 @@ class OpenAILLM(LLM):
         self._model_name = settings.model_name
         self._temperature = settings.temperature
         self._max_tokens = settings.max_tokens
+        self._max_context_tokens = settings.max_context_tokens
         self._compression_service = compression_service
+        # Keyed by id() of the caller's message list, which is kept alive in the value.
+        # The last message of the compressed prefix is kept to detect in-place roll backs.
+        # Pending: (source messages, compressed prefix length, prefix tail message, compression task)
+        self._pending_compression: Dict[int, Tuple[List[Dict[str, Any]], int, Optional[Dict[str, Any]], asyncio.Task]] = {}
+        # Cache: (source messages, compressed prefix length, prefix tail message, compressed prefix messages)
+        self._compressed_cache: Dict[int, Tuple[List[Dict[str, Any]], int, Optional[Dict[str, Any]], List[Dict[str, Any]]]] = {}
         logger.info(f"Initialized OpenAI LLM with model: {self._model_name}")
     
     @property
@@ -37,50 +59,174 @@ class OpenAILLM(LLM):
                             tools: Optional[List[Dict[str, Any]]] = None,
                             response_format: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
         """Send chat request to OpenAI API"""
-        response = None
+        if self._compression_service:
+            messages = self._prepare_messages(messages)
+        
+        kwargs = {
+            "model": self._model_name,
+            "temperature": self._temperature,
+            "max_tokens": self._max_tokens,
+        }
+        if tools:
+            kwargs["tools"] = tools
+        if response_format:
+            kwargs["response_format"] = response_format
+        
+        for attempt in range(self.MAX_ATTEMPTS):
+            try:
+                logger.debug(f"Sending request to OpenAI {'with' if tools else 'without'} tools, model: {self._model_name}")
+                response = await self.client.chat.completions.create(messages=messages, **kwargs)
+                return response.choices[0].message.model_dump()
+            except Exception as e:
+                # Check if token limit error and has compression service
+                if attempt < self.MAX_ATTEMPTS - 1 and self._compression_service and self._is_token_limit_error(e):
+                    logger.warning(f"Token limit exceeded, attempting compression")
+                    messages = await self._compression_service.handle_token_overflow(
+                        messages, str(e)
+                    )
+                    logger.info(f"Retrying with compressed messages (attempt {attempt + 2}/{self.MAX_ATTEMPTS})")
+                    continue
+                
+                logger.error(f"Error calling OpenAI API: {str(e)}")
+                raise
+    
+    async def ask_stream(self, messages: List[Dict[str, str]],
+                         response_format: Optional[Dict[str, Any]] = None) -> AsyncGenerator[str, None]:
+        """Stream chat response content from OpenAI API
+        
+        Closing the generator early aborts the underlying HTTP request.
+        Token limit errors are not retried with compression.
+        """
+        logger.debug(f"Sending streaming request to OpenAI, model: {self._model_name}")
+        kwargs = {}
+        if response_format:
+            kwargs["response_format"] = response_format
+        stream = await self.client.chat.completions.create(
+            model=self._model_name,
+            temperature=self._temperature,
+            max_tokens=self._max_tokens,
+            messages=messages,
+            stream=True,
+            **kwargs
+        )
         try:
-            if tools:
-                logger.debug(f"Sending request to OpenAI with tools, model: {self._model_name}")
-                response = await self.client.chat.completions.create(
-                    model=self._model_name,
-                    temperature=self._temperature,
-                    max_tokens=self._max_tokens,
-                    messages=messages,
-                    tools=tools,
-                    response_format=response_format,
-                )
-            else:
-                logger.debug(f"Sending request to OpenAI without tools, model: {self._model_name}")
-                response = await self.client.chat.completions.create(
-                    model=self._model_name,
-                    temperature=self._temperature,
-                    max_tokens=self._max_tokens,
-                    messages=messages,
-                    response_format=response_format
-                )
-            return response.choices[0].message.model_dump()
-        except Exception as e:
-            # Added: Check if token limit error and has compression service
-            if self._compression_service and self._is_token_limit_error(e):
-                logger.warning(f"Token limit exceeded, attempting compression")
-                compressed_messages = await self._compression_service.handle_token_overflow(
-                    messages, str(e)
-                )
-                # Recursive retry (compression service controls max retry count)
-                logger.info("Retrying with compressed messages")
-                return await self.ask(compressed_messages, tools, response_format)
-            
-            logger.error(f"Error calling OpenAI API: {str(e)}")
-            raise
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            await stream.close()
     
     def _is_token_limit_error(self, error: Exception) -> bool:
         """Check if error is token limit exceeded"""
-        error_msg = str(error).lower()
-        token_error_keywords = [
-            'context_length_exceeded', 
-            'token limit', 
-            'maximum context length',
-            'request too large',
-            'too many tokens'
-        ]
-        return any(keyword in error_msg for keyword in token_error_keywords)
\ No newline at end of file
+        return _TOKEN_LIMIT_ERROR_RE.search(str(error)) is not None
+    
+    def _prepare_messages(self, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Apply finished background compression and schedule a new one if needed
+        
+        The current request never waits for compression: a compression started
+        here is only applied to subsequent requests on the same message list.
+        """
+        source = messages
+        key = id(source)
+        
+        pending = self._pending_compression.get(key)
+        if pending and pending[0] is source and pending[3].done():
+            del self._pending_compression[key]
+            _, prefix_length, prefix_tail, task = pending
+            # Failures are logged by _log_compression_failure
+            if not task.cancelled() and task.exception() is None:
+                self._store_compressed(source, prefix_length, prefix_tail, task.result())
+        
+        cached = self._compressed_cache.get(key)
+        if cached and cached[0] is source:
+            _, prefix_length, prefix_tail, compressed = cached
+            if self._is_prefix_unchanged(source, prefix_length, prefix_tail):
+                messages = compressed + source[prefix_length:]
+            else:
+                # Message list was rolled back into the compressed prefix
+                del self._compressed_cache[key]
+        
+        if key not in self._pending_compression:
+            try:
+                self._schedule_compression(source, messages)
+            except Exception as e:
+                # Background compression is an optimization and must not fail the request
+                logger.error(f"Failed to schedule background compression: {e}")
+        
+        return messages
+    
+    def _schedule_compression(self, source: List[Dict[str, Any]], messages: List[Dict[str, Any]]) -> None:
+        """Start background compression if messages exceed the soft limit"""
+        estimated_tokens = self._compression_service.estimate_tokens(messages)
+        if estimated_tokens <= self.COMPRESSION_SOFT_LIMIT_RATIO * self._max_context_tokens:
+            return
+        
+        # Only compress up to a point where every tool call has its tool returns
+        complete_length = self._get_complete_prefix_length(messages)
+        prefix_length = len(source) - (len(messages) - complete_length)
+        if not complete_length or prefix_length <= 0:
+            return
+        
+        logger.info(f"Estimated {estimated_tokens} tokens, starting background compression")
+        task = asyncio.create_task(
+            self._compression_service.compress_messages(
+                messages[:complete_length],
+                int(self._max_context_tokens * self.COMPRESSION_TARGET_RATIO)
+            )
+        )
+        # Tasks of lists that are never asked again, or evicted ones, are not awaited
+        task.add_done_callback(self._log_compression_failure)
+        prefix_tail = self._get_prefix_tail(source, prefix_length)
+        self._pending_compression[id(source)] = (source, prefix_length, prefix_tail, task)
+        # Message lists that are never asked again would otherwise pile up
+        while len(self._pending_compression) > self.MAX_COMPRESSION_CACHE_SIZE:
+            oldest_key = next(iter(self._pending_compression))
+            self._pending_compression.pop(oldest_key)[3].cancel()
+    
+    def _log_compression_failure(self, task: asyncio.Task) -> None:
+        """Retrieve and log the exception of a finished background compression"""
+        if task.cancelled():
+            return
+        error = task.exception()
+        if error:
+            logger.warning(f"Background compression failed: {error}")
+    
+    def _store_compressed(self, source: List[Dict[str, Any]], prefix_length: int,
+                          prefix_tail: Optional[Dict[str, Any]],
+                          compressed: List[Dict[str, Any]]) -> None:
+        """Cache compressed prefix of a message list"""
+        if not self._is_prefix_unchanged(source, prefix_length, prefix_tail):
+            logger.info("Message list changed during background compression, discarding result")
+            return
+        key = id(source)
+        self._compressed_cache.pop(key, None)
+        self._compressed_cache[key] = (source, prefix_length, prefix_tail, compressed)
+        # Drop the oldest entries (dicts preserve insertion order)
+        while len(self._compressed_cache) > self.MAX_COMPRESSION_CACHE_SIZE:
+            del self._compressed_cache[next(iter(self._compressed_cache))]
+    
+    def _get_complete_prefix_length(self, messages: List[Dict[str, Any]]) -> int:
+        """Get length of the longest prefix without unanswered tool calls"""
+        answered_ids = set()
+        for index in range(len(messages) - 1, -1, -1):
+            message = messages[index]
+            if message.get("role") == "tool":
+                answered_ids.add(message.get("tool_call_id"))
+            elif message.get("role") == "assistant":
+                tool_calls = message.get("tool_calls") or []
+                if all(tool_call.get("id") in answered_ids for tool_call in tool_calls):
+                    return len(messages)
+                return index
+        return len(messages)
+    
+    def _get_prefix_tail(self, source: List[Dict[str, Any]], prefix_length: int) -> Optional[Dict[str, Any]]:
+        """Get the last message of a prefix"""
+        return source[prefix_length - 1] if prefix_length else None
+    
+    def _is_prefix_unchanged(self, source: List[Dict[str, Any]], prefix_length: int,
+                             prefix_tail: Optional[Dict[str, Any]]) -> bool:
+        """Check that a prefix was not rolled back and replaced since it was recorded
+        
+        The tail message object is held by the caller, so its identity cannot be reused.
+        """
+        return len(source) >= prefix_length and self._get_prefix_tail(source, prefix_length) is prefix_tail
@@ -1,17 +1,22 @@
-from typing import List, Dict, Any
-from app.domain.models.compression_result import CompressionResult, CompressionSegment
+from typing import Any, Optional
+from app.domain.models.compression_result import CompressionSegment
 from app.domain.external.compression import CompressionEngine, TokenAnalyzer
 from app.domain.utils.json_parser import JsonParser
 import logging
-import json
+import time
+import orjson
 
 logger = logging.getLogger(__name__)
 
+# Roles whose messages may be compressed
+_COMPRESSIBLE_ROLES = frozenset({"user", "tool"})
+
 class CompressionService:
     """Compression service implementation - Infrastructure layer"""
     
     MAX_COMPRESSION_ROUNDS = 3
     SYSTEM_PROMPT_RATIO = 0.25  # 1/4 for system prompt
+    MESSAGE_FORMAT_OVERHEAD = 16  # Characters added by _format_message_content
     
     def __init__(self, compression_engine: CompressionEngine, 
                  token_analyzer: TokenAnalyzer,
@@ -20,42 +25,43 @@ class CompressionService:
         self._token_analyzer = token_analyzer
         self._json_parser = json_parser
     
-    def _should_compress_message(self, message: Dict) -> bool:
+    def _should_compress_message(self, message: dict, role: str) -> bool:
         """Determine if a message should be compressed
         
         Only compress:
         - User input (role="user") 
         - Tool returns (role="tool")
+        - Assistant tool calls (role="assistant" with tool_calls) - their tool
+          returns are compressed, and APIs reject tool_calls without them
         
         Do not compress:
         - System messages (role="system") - handled separately
         - Assistant responses (role="assistant") - may contain JSON structures
         """
-        role = message.get("role", "")
-        return role in ["user", "tool"]
+        return role in _COMPRESSIBLE_ROLES or (role == "assistant" and bool(message.get("tool_calls")))
     
-    def _separate_messages_by_compression_policy(self, messages: List[Dict]) -> tuple[List[Dict], List[Dict], List[Dict]]:
+    def _separate_messages_by_compression_policy(self, messages: list[dict]) -> tuple[list[dict], list[dict], list[dict]]:
         """Separate messages by compression policy
         
         Returns:
             tuple: (system_messages, compressible_messages, protected_messages)
         """
         system_messages = []      # System messages - not compressed
-        compressible_messages = [] # Compressible messages - user, tool
+        compressible_messages = [] # Compressible messages - user, tool, assistant tool calls
         protected_messages = []    # Protected messages - assistant (LLM responses)
         
         for msg in messages:
             role = msg.get("role", "")
             if role == "system":
                 system_messages.append(msg)
-            elif self._should_compress_message(msg):
+            elif self._should_compress_message(msg, role):
                 compressible_messages.append(msg)
             else:
                 protected_messages.append(msg)
         
         return system_messages, compressible_messages, protected_messages
 
-    async def handle_token_overflow(self, messages: List[Dict], error_info: str) -> List[Dict]:
+    async def handle_token_overflow(self, messages: list[dict], error_info: str) -> list[dict]:
         """Main entry point for handling token overflow"""
         logger.info(f"Handling token overflow for {len(messages)} messages")
         
@@ -64,89 +70,106 @@ class CompressionService:
             max_tokens, current_tokens = self._token_analyzer.parse_error_info(error_info)
             logger.info(f"Token limits: max={max_tokens}, current={current_tokens}")
             
-            # 2. Calculate compression budget
-            system_budget = int(max_tokens * self.SYSTEM_PROMPT_RATIO)
-            compression_budget = max_tokens - system_budget
-            logger.info(f"Compression budget: {compression_budget} tokens")
-            
-            # 3. Separate messages by compression policy
-            system_messages, compressible_messages, protected_messages = self._separate_messages_by_compression_policy(messages)
-            logger.info(f"Message separation: system={len(system_messages)}, compressible={len(compressible_messages)}, protected={len(protected_messages)}")
-            
-            # 4. Execute progressive compression only on compressible messages
-            result_messages = system_messages.copy()
-            
-            if compressible_messages:
-                compressed_content = await self._progressive_compression(
-                    compressible_messages, compression_budget
-                )
-                compressed_msg = self._build_compressed_message(compressed_content)
-                result_messages.append(compressed_msg)
-                logger.info(f"Compressed {len(compressible_messages)} compressible messages")
-            else:
-                logger.info("No compressible messages found")
-            
-            # 5. Add protected messages (assistant responses) without compression
-            result_messages.extend(protected_messages)
-            
-            logger.info(f"Compression completed: {len(result_messages)} messages")
-            return result_messages
+            return await self.compress_messages(messages, max_tokens)
             
         except Exception as e:
             logger.error(f"Compression failed: {e}")
             # If compression fails, return most simplified messages
             return self._emergency_fallback(messages)
     
-    def _separate_system_messages(self, messages: List[Dict]) -> tuple[List[Dict], List[Dict]]:
-        """Separate system messages from other messages - DEPRECATED
+    async def compress_messages(self, messages: list[dict], max_tokens: int) -> list[dict]:
+        """Compress messages to fit within max_tokens
         
-        This method is kept for backward compatibility but should use 
-        _separate_messages_by_compression_policy instead
+        Unlike handle_token_overflow, errors are propagated to the caller
+        instead of falling back to the emergency strategy.
         """
-        system_messages = []
-        other_messages = []
+        # 2. Calculate compression budget
+        system_budget = int(max_tokens * self.SYSTEM_PROMPT_RATIO)
+        compression_budget = max_tokens - system_budget
+        logger.info(f"Compression budget: {compression_budget} tokens")
         
-        for msg in messages:
-            if msg.get("role") == "system":
-                system_messages.append(msg)
-            else:
-                other_messages.append(msg)
+        # 3. Separate messages by compression policy
+        system_messages, compressible_messages, protected_messages = self._separate_messages_by_compression_policy(messages)
+        logger.info(f"Message separation: system={len(system_messages)}, compressible={len(compressible_messages)}, protected={len(protected_messages)}")
         
-        return system_messages, other_messages
-
-    async def _progressive_compression(self, messages: List[Dict], budget_tokens: int) -> str:
-        """Progressive compression implementation"""
+        # 4. Execute progressive compression only on compressible messages
+        compressed_messages = []
+        
+        if compressible_messages:
+            # Estimate each message once and reuse the counts for segmentation
+            token_counts = [self._estimate_message_tokens(msg) for msg in compressible_messages]
+            # Dropping old tool outputs is tried first, since it needs no LLM call.
+            # Once history was compressed, older results live in the summary and the
+            # remaining tool messages are the newest ones, so they must not be dropped.
+            compressed_content = None
+            if not any(msg.get("_compressed") for msg in compressible_messages):
+                # System and protected messages are sent unchanged, so they count against the budget
+                uncompressed_tokens = self.estimate_tokens(system_messages) + self.estimate_tokens(protected_messages)
+                truncation_budget = min(compression_budget, max_tokens - uncompressed_tokens)
+                compressed_content = self._truncate_to_budget(
+                    compressible_messages, token_counts, truncation_budget
+                )
+            if compressed_content is None:
+                compressed_content = await self._progressive_compression(
+                    compressible_messages, token_counts, compression_budget
+                )
+            compressed_messages.append(self._build_compressed_message(compressed_content))
+            logger.info(f"Compressed {len(compressible_messages)} compressible messages")
+        else:
+            logger.info("No compressible messages found")
+        
+        # 5. Add protected messages (assistant responses) without compression
+        result_messages = [*system_messages, *compressed_messages, *protected_messages]
+        
+        logger.info(f"Compression completed: {len(result_messages)} messages")
+        return result_messages
+    
+    def estimate_tokens(self, messages: list[dict]) -> int:
+        """Estimate total token count of messages"""
+        return sum(self._estimate_message_tokens(msg) for msg in messages)
+    
+    def _truncate_to_budget(self, messages: list[dict], token_counts: list[int], budget_tokens: int) -> Optional[str]:
+        """Drop oldest tool messages until the rest fits the budget
+        
+        Returns:
+            Concatenated remaining content, or None if nothing was dropped or
+            dropping all tool messages is not enough
+        """
+        total_tokens = sum(token_counts)
+        dropped = set()
+        for index, msg in enumerate(messages):
+            if total_tokens <= budget_tokens:
+                break
+            if msg.get("role") == "tool":
+                dropped.add(index)
+                total_tokens -= token_counts[index]
+        
+        # Without dropping anything the history would be resent at the same size
+        if not dropped or total_tokens > budget_tokens:
+            return None
+        
+        logger.info(f"Content fits budget after dropping {len(dropped)} tool messages, skipping compression")
+        content = "\n\n".join(
+            self._format_message_content(msg)
+            for index, msg in enumerate(messages) if index not in dropped
+        )
+        return content + f"\n\n[Notice: {len(dropped)} earlier tool results omitted]"
+    
+    async def _progressive_compression(self, messages: list[dict], token_counts: list[int], budget_tokens: int) -> str:
+        """Progressive compression implementation (map-reduce over segments)"""
         logger.info(f"Starting progressive compression with budget: {budget_tokens}")
         
         # Segmentation logic: reserve half budget for compression operations
         segment_budget = budget_tokens // 2
-        segments = self._split_into_segments(messages, segment_budget)
+        segments = self._split_into_segments(messages, token_counts, segment_budget)
         
         logger.info(f"Split into {len(segments)} segments")
         
-        cumulative_summary = ""
-        
-        # Maximum 3 compression rounds
-        compression_rounds = min(len(segments), self.MAX_COMPRESSION_ROUNDS)
-        
-        for round_num in range(compression_rounds):
-            segment = segments[round_num]
-            segment_content = self._format_segment_content(segment.content)
-            
-            logger.info(f"Compressing round {round_num + 1}/{compression_rounds}")
-            
-            try:
-                # Call compression engine
-                cumulative_summary = await self._compression_engine.compress_content(
-                    cumulative_summary, segment_content, segment_budget
-                )
-            except Exception as e:
-                logger.error(f"Compression round {round_num + 1} failed: {e}")
-                # If compression round fails, use simple concatenation
-                if cumulative_summary:
-                    cumulative_summary += f"\n\n[Round {round_num + 1} compression failed, original content]: {segment_content[:200]}..."
-                else:
-                    cumulative_summary = f"[Compression failed, original content]: {segment_content[:500]}..."
+        # Maximum 3 compression rounds, compressed in one batch
+        partial_summaries = await self._map_compress(
+            segments[:self.MAX_COMPRESSION_ROUNDS], segment_budget
+        )
+        cumulative_summary = await self._reduce_summaries(partial_summaries, segment_budget)
         
         # If there are unprocessed segments, add notice
         if len(segments) > self.MAX_COMPRESSION_ROUNDS:
@@ -155,73 +178,128 @@ class CompressionService:
         
         return cumulative_summary
     
-    def _split_into_segments(self, messages: List[Dict], segment_budget: int) -> List[CompressionSegment]:
+    async def _map_compress(self, segments: list[CompressionSegment], segment_budget: int) -> list[str]:
+        """Compress each segment independently in a single batch request"""
+        segment_contents = [self._format_segment_content(s.content) for s in segments]
+        try:
+            return await self._compression_engine.compress_batch(segment_contents, segment_budget)
+        except Exception as e:
+            logger.error(f"Compression of {len(segments)} segments failed: {e}")
+            # If compression fails, use truncated original content
+            return [
+                f"[Segment {index + 1} compression failed, original content]: {content[:500]}..."
+                for index, content in enumerate(segment_contents)
+            ]
+    
+    async def _reduce_summaries(self, summaries: list[str], segment_budget: int) -> str:
+        """Merge partial summaries into a single summary"""
+        if not summaries:
+            return ""
+        if len(summaries) == 1:
+            return summaries[0]
+        
+        joined_summaries = "\n---\n".join(summaries)
+        # Partial summaries that already fit are concatenated without another LLM call
+        if self._token_analyzer.estimate_tokens(joined_summaries) <= segment_budget:
+            return joined_summaries
+        
+        logger.info(f"Merging {len(summaries)} partial summaries")
+        try:
+            return await self._compression_engine.compress_content("", joined_summaries, segment_budget)
+        except Exception as e:
+            logger.error(f"Merging partial summaries failed: {e}")
+            # If merge fails, keep the partial summaries as they are
+            return joined_summaries
+    
+    def _split_into_segments(self, messages: list[dict], token_counts: list[int], segment_budget: int) -> list[CompressionSegment]:
         """Split messages into appropriately sized segments"""
         segments = []
-        current_content = ""
+        current_parts: list[str] = []
         current_tokens = 0
-        current_types = []
+        current_types: set[str] = set()
         
-        for msg in messages:
-            msg_content = self._format_message_content(msg)
-            msg_tokens = self._token_analyzer.estimate_tokens(msg_content)
+        for msg, msg_tokens in zip(messages, token_counts):
             msg_type = msg.get("role", "unknown")
             
             # Check if need to start new segment
-            if current_tokens + msg_tokens > segment_budget and current_content:
+            if current_tokens + msg_tokens > segment_budget and current_parts:
                 # Save current segment
                 segments.append(CompressionSegment(
-                    content=current_content,
-                    estimated_tokens=current_tokens,
-                    message_types=list(set(current_types))
+                    "\n\n".join(current_parts), current_tokens, list(current_types)
                 ))
                 
                 # Start new segment
-                current_content = msg_content
-                current_tokens = msg_tokens
-                current_types = [msg_type]
-            else:
-                # Add to current segment
-                current_content += "\n\n" + msg_content if current_content else msg_content
-                current_tokens += msg_tokens
-                current_types.append(msg_type)
+                current_parts = []
+                current_tokens = 0
+                current_types = set()
+            
+            # Add to current segment, formatting only when the message is appended
+            current_parts.append(self._format_message_content(msg))
+            current_tokens += msg_tokens
+            current_types.add(msg_type)
         
         # Add last segment
-        if current_content:
+        if current_parts:
             segments.append(CompressionSegment(
-                content=current_content,
-                estimated_tokens=current_tokens,
-                message_types=list(set(current_types))
+                "\n\n".join(current_parts), current_tokens, list(current_types)
             ))
         
         return segments
     
-    def _format_message_content(self, message: Dict) -> str:
+    def _format_message_content(self, message: dict) -> str:
         """Format single message content"""
         role = message.get("role", "unknown")
-        content = message.get("content", "")
+        content = self._get_content_text(message)
         
         # Handle special format for tool messages
         if role == "tool":
             tool_call_id = message.get("tool_call_id", "")
             return f"[Tool call result {tool_call_id}]: {content}"
+        elif message.get("tool_calls"):
+            return f"[{role}]: {content}\n{self._format_tool_calls(message)}"
         else:
             return f"[{role}]: {content}"
     
+    def _estimate_message_tokens(self, message: dict) -> int:
+        """Estimate message tokens without building the formatted string"""
+        content = self._get_content_text(message)
+        role = message.get("role") or ""
+        tokens = self._token_analyzer.estimate_tokens(content) + (len(role) + self.MESSAGE_FORMAT_OVERHEAD) // 3
+        if message.get("tool_calls"):
+            tokens += self._token_analyzer.estimate_tokens(self._format_tool_calls(message))
+        return tokens
+    
+    def _get_content_text(self, message: dict) -> str:
+        """Get message content as text, serializing structured content as compact JSON"""
+        content = message.get("content")
+        if content is None:
+            return ""
+        if isinstance(content, str):
+            return content
+        return orjson.dumps(content, default=str).decode()
+    
+    def _format_tool_calls(self, message: dict) -> str:
+        """Format tool calls of an assistant message"""
+        lines = []
+        for tool_call in message.get("tool_calls") or []:
+            function = tool_call.get("function") or {}
+            lines.append(f"[Tool call {tool_call.get('id', '')}]: {function.get('name', '')}({function.get('arguments', '')})")
+        return "\n".join(lines)
+    
     def _format_segment_content(self, content: str) -> str:
         """Format segment content for compression"""
         return content
     
-    def _build_compressed_message(self, compressed_content: str) -> Dict[str, Any]:
+    def _build_compressed_message(self, compressed_content: str) -> dict[str, Any]:
         """Build compressed message"""
         return {
             "role": "user",
             "content": f"[Compressed historical conversation content]\n\n{compressed_content}",
             "_compressed": True,  # Mark as compressed
-            "_compression_timestamp": int(__import__("time").time())
+            "_compression_timestamp": int(time.time())
         }
     
-    def _emergency_fallback(self, messages: List[Dict]) -> List[Dict]:
+    def _emergency_fallback(self, messages: list[dict]) -> list[dict]:
         """Emergency fallback strategy"""
         logger.warning("Using emergency fallback strategy")
         